@@ -3,10 +3,25 @@ Footfall Counter using Computer Vision
 Detects, tracks, and counts people crossing a virtual line
 """
 
+import argparse
+import os
+import queue
+import sys
+import threading
 import cv2
 import numpy as np
-from collections import defaultdict
+import torch
+from numba import njit
+from pathlib import Path
+from types import SimpleNamespace
 from ultralytics import YOLO
+from ultralytics.engine.results import Boxes
+from ultralytics.nn.autobackend import AutoBackend
+from ultralytics.trackers import BYTETracker
+try:
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:  # ultralytics < 8.3.200
+    from ultralytics.utils.ops import non_max_suppression
 
 # Configuration
 # VIDEO_PATH = 0
@@ -15,75 +30,440 @@ VIDEO_PATH = "mall.mp4"
 CONFIDENCE_THRESHOLD = 0.4
 LINE_POSITION = 0.5  # Position of counting line (0.5 = middle of frame)
 TRACK_HISTORY_LENGTH = 30
+STALE_TRACK_FRAMES = 300  # Forget tracks that have not been seen for this many frames
+MODEL_PATH = "yolov8n.pt"  # YOLOv8 nano for speed
+USE_TENSORRT = True  # Export once to a cached TensorRT engine (or ONNX if TensorRT is unavailable)
+ENGINE_PRECISION = "fp16"  # "fp16" or "int8" (re-check CONFIDENCE_THRESHOLD on a validation clip for int8)
+CALIBRATION_FRAMES = 500  # Frames sampled from VIDEO_PATH for INT8 calibration
+INFERENCE_SIZE = 640  # Longest input side for PyTorch/ONNX inference (TensorRT engines use the full frame)
+BATCH_SIZE = 8  # Frames per inference call (the TensorRT engine is built for this batch)
+DETECTION_STRIDE = 3  # Run detection on every Nth frame and extrapolate boxes in between
+CROWD_THRESHOLD = 15  # Detect on every frame while more people than this are in view
+TRACKER_ARGS = dict(tracker_type='bytetrack', track_high_thresh=0.25, track_low_thresh=0.1,
+                    new_track_thresh=0.25, track_buffer=30, match_thresh=0.8, fuse_score=True)
+USE_HW_DECODE = True  # Decode H.264 files on the GPU (NVDEC) through FFmpeg's h264_cuvid
+OUTPUT_PATH = None  # Set to e.g. "output.mp4" to save the annotated video
+PREVIEW_SCALE = 0.5  # Scale of the preview window (detection and saved video stay full resolution)
+
+def open_video(source):
+    """Open a video source, preferring NVDEC hardware decoding for video files"""
+    if USE_HW_DECODE and isinstance(source, str):
+        # FFmpeg reads its capture options when the file is opened, so they can be restored right after
+        previous_options = os.environ.get("OPENCV_FFMPEG_CAPTURE_OPTIONS")
+        hw_options = "video_codec;h264_cuvid"
+        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = f"{previous_options}|{hw_options}" if previous_options else hw_options
+        try:
+            cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG)
+        finally:
+            if previous_options is None:
+                del os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"]
+            else:
+                os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = previous_options
+        
+        if cap.isOpened() and cap.grab():
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Rewind after the probe frame
+            return cap
+        
+        cap.release()
+        print("Warning: hardware decoding unavailable, falling back to CPU decoder")
+    
+    return cv2.VideoCapture(source)
+
+def write_calibration_set(video_path, out_dir, names, num_frames=CALIBRATION_FRAMES):
+    """Sample frames evenly across the video into a YOLO dataset used for INT8 calibration"""
+    images_dir = Path(out_dir) / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(total_frames // num_frames, 1)
+    
+    frame_idx = saved = 0
+    while saved < num_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_idx % step == 0:
+            cv2.imwrite(str(images_dir / f"{frame_idx:06d}.jpg"), frame)
+            saved += 1
+        frame_idx += 1
+    cap.release()
+    
+    # Labels are not needed for calibration, only the images
+    data_yaml = Path(out_dir) / "calibration.yaml"
+    lines = [f"path: {Path(out_dir).resolve()}", "train: images", "val: images", "names:"]
+    lines += [f"  {i}: {name}" for i, name in names.items()]
+    data_yaml.write_text("\n".join(lines) + "\n")
+    return data_yaml
+
+def letterbox_shape(frame_size, size=INFERENCE_SIZE, stride=32):
+    """Return the (h, w) network input that fits a frame into size, padded to the stride like ultralytics"""
+    gain = size / max(frame_size)
+    return tuple(int(np.ceil(round(d * gain) / stride) * stride) for d in frame_size)
+
+def onnx_cache_path(weights, frame_size):
+    """Return where the ONNX fallback export for a frame size is cached"""
+    imgsz = letterbox_shape(frame_size)
+    return weights.with_name(f"{weights.stem}_b{BATCH_SIZE}_{imgsz[0]}x{imgsz[1]}.onnx")
+
+def load_onnx_model(weights, frame_size):
+    """Load a cached ONNX export of the weights, run by ONNX Runtime (CUDA provider on GPUs)"""
+    imgsz = letterbox_shape(frame_size)
+    onnx_path = onnx_cache_path(weights, frame_size)
+    if not onnx_path.exists():
+        print(f"Exporting ONNX model {onnx_path}...")
+        try:
+            exported = YOLO(str(weights)).export(format='onnx', imgsz=imgsz, batch=BATCH_SIZE, opset=17,
+                                                 simplify=True, dynamic=False, verbose=False)
+            Path(exported).replace(onnx_path)
+        except Exception as e:
+            print(f"Warning: ONNX export failed ({e}), using PyTorch weights")
+            return YOLO(str(weights))
+    
+    return YOLO(str(onnx_path), task='detect')
+
+def load_model(weights, imgsz=None, precision=ENGINE_PRECISION):
+    """Load YOLO weights, preferring a cached TensorRT engine, then ONNX Runtime, built for imgsz (h, w)"""
+    if not USE_TENSORRT or imgsz is None:
+        return YOLO(weights)
+    
+    # Engine shapes are frozen at build time, so cache one engine per precision and input size
+    weights = Path(weights)
+    engine_path = weights.with_name(f"{weights.stem}_{precision}_b{BATCH_SIZE}_{imgsz[0]}x{imgsz[1]}.engine")
+    if not engine_path.exists() and onnx_cache_path(weights, imgsz).exists():
+        # Only cached after a failed TensorRT build, so skip retrying it on every start
+        print("Using the cached ONNX fallback model (delete it to retry the TensorRT build)")
+        return load_onnx_model(weights, imgsz)
+    
+    if not engine_path.exists():
+        print(f"Building TensorRT engine {engine_path} (one-time, may take a few minutes)...")
+        try:
+            model = YOLO(str(weights))
+            export_args = dict(format='engine', imgsz=imgsz, batch=BATCH_SIZE, dynamic=False,
+                               workspace=4, verbose=False)
+            if precision == "int8":
+                # Calibrated on frames from the deployment video. The calibrator depends on the ultralytics
+                # version: recent exporters use MinMax, older ones (e.g. 8.3.0) use entropy calibration and
+                # force dynamic shapes for INT8, so there "b8" in the engine name is the maximum batch
+                calibration_dir = weights.with_name("calibration")
+                export_args.update(int8=True, fraction=1.0,
+                                   data=str(write_calibration_set(VIDEO_PATH, calibration_dir, model.names)))
+            else:
+                export_args.update(half=True)
+            exported = model.export(**export_args)
+            Path(exported).replace(engine_path)
+        except Exception as e:
+            print(f"Warning: TensorRT export failed ({e}), falling back to ONNX Runtime")
+            return load_onnx_model(weights, imgsz)
+    
+    return YOLO(str(engine_path), task='detect')
+
+def fp16_supported():
+    """Return whether a CUDA GPU with fast FP16 (Tensor Cores, compute capability 7.0+) is available"""
+    if not torch.cuda.is_available():
+        return False
+    
+    major, minor = torch.cuda.get_device_capability()
+    if major < 7:
+        print(f"Warning: GPU compute capability {major}.{minor} has no fast FP16, using FP32 inference")
+        return False
+    return True
+
+def make_detections(xyxy, track_ids):
+    """Pack tracked boxes into per-frame detection arrays: boxes, centroids, and track IDs"""
+    xyxy = np.asarray(xyxy).astype(np.int32).reshape(-1, 4)
+    return {
+        'xyxy': xyxy,
+        'cxy': (xyxy[:, :2] + xyxy[:, 2:]) // 2,
+        'ids': np.asarray(track_ids).astype(np.int64).reshape(-1)
+    }
+
+@njit(cache=True)
+def _update_counts_kernel(centroids, slots, hist_x, hist_y, hist_head, hist_len, counted, line_y):
+    """Append centroids to the track ring buffers and count line crossings, returns (entries, exits)"""
+    history_length = hist_y.shape[1]
+    entries = 0
+    exits = 0
+    for i in range(slots.shape[0]):
+        slot = slots[i]
+        head = hist_head[slot]
+        prev_y = hist_y[slot, (head - 1) % history_length]
+        curr_y = centroids[i, 1]
+        pending = hist_len[slot] >= 1 and not counted[slot]
+        
+        # Store track history, overwriting the oldest entry once the ring is full
+        hist_x[slot, head] = centroids[i, 0]
+        hist_y[slot, head] = curr_y
+        hist_head[slot] = (head + 1) % history_length
+        hist_len[slot] = min(hist_len[slot] + 1, history_length)
+        
+        if pending:
+            # Crossed from top to bottom (Entry)
+            if prev_y < line_y and curr_y >= line_y:
+                entries += 1
+                counted[slot] = True
+            # Crossed from bottom to top (Exit)
+            elif prev_y > line_y and curr_y <= line_y:
+                exits += 1
+                counted[slot] = True
+    
+    return entries, exits
+
+@njit(cache=True)
+def _iou_distance_kernel(track_boxes, det_boxes, det_scores):
+    """Return the ByteTrack matching cost 1 - IoU * score between xyxy track and detection boxes"""
+    dists = np.ones((track_boxes.shape[0], det_boxes.shape[0]), np.float32)
+    for i in range(track_boxes.shape[0]):
+        tx1, ty1, tx2, ty2 = track_boxes[i]
+        track_area = (tx2 - tx1) * (ty2 - ty1)
+        for j in range(det_boxes.shape[0]):
+            dx1, dy1, dx2, dy2 = det_boxes[j]
+            inter_w = min(tx2, dx2) - max(tx1, dx1)
+            inter_h = min(ty2, dy2) - max(ty1, dy1)
+            if inter_w <= 0 or inter_h <= 0:
+                continue
+            inter = inter_w * inter_h
+            union = track_area + (dx2 - dx1) * (dy2 - dy1) - inter + 1e-7
+            dists[i, j] = 1 - inter / union * det_scores[j]
+    return dists
+
+class NumbaBYTETracker(BYTETracker):
+    """ByteTrack with the IoU cost matrix computed by a compiled kernel instead of NumPy temporaries"""
+    def get_dists(self, tracks, detections):
+        track_boxes = np.array([track.xyxy for track in tracks], np.float32).reshape(-1, 4)
+        det_boxes = np.array([det.xyxy for det in detections], np.float32).reshape(-1, 4)
+        if self.args.fuse_score:
+            det_scores = np.array([det.score for det in detections], np.float32)
+        else:
+            det_scores = np.ones(len(detections), np.float32)
+        return _iou_distance_kernel(track_boxes, det_boxes, det_scores)
 
 class FootfallCounter:
-    def __init__(self, line_position=0.5):
-        """Initialize the footfall counter with counting line position"""
-        self.model = YOLO('yolov8n.pt')  # Using YOLOv8 nano for speed
+    def __init__(self, line_position=0.5, frame_size=None):
+        """Initialize the footfall counter with counting line position and (height, width) frame size"""
+        self.model = load_model(MODEL_PATH, frame_size)
+        
+        # Engines have their precision baked in, PyTorch weights run in FP16 on capable GPUs
+        self.half = Path(self.model.ckpt_path).suffix == '.pt' and fp16_supported()
+        torch.set_float32_matmul_precision('high')
+        
+        # Run the network directly, preprocessing on the device instead of in ultralytics' predictor
+        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        self.backend = AutoBackend(self.model.model, device=self.device, fp16=self.half, verbose=False)
+        if Path(self.model.ckpt_path).suffix == '.engine':
+            # Engines are built for the full frame, rounded up to the stride like the exporter does
+            self.input_shape = tuple(int(np.ceil(d / 32) * 32) for d in frame_size)
+        else:
+            self.input_shape = letterbox_shape(frame_size) if frame_size else (INFERENCE_SIZE, INFERENCE_SIZE)
+        
+        # track_buffer counts tracker updates, as with model.track()'s default 30 FPS tracker
+        self.tracker = NumbaBYTETracker(SimpleNamespace(**TRACKER_ARGS))
+        self.frame_idx = 0
+        self._set_stride(DETECTION_STRIDE)
+        self.last_key_idx = 0
+        self.last_key_detections = make_detections([], [])
         self.line_position = line_position
-        self.track_history = defaultdict(list)
-        self.counted_ids = set()
+        self.counting_line_y = None  # Computed from the first frame's height
+        # Track history as a ring buffer per track: one row per track ID, grown on demand
+        self.track_slots = {}
+        self.free_slots = []  # Rows released by pruned tracks, reused before growing
+        self.next_slot = 0
+        self.frames_seen = 0
+        self.hist_x = np.full((1024, TRACK_HISTORY_LENGTH), -1, np.int32)
+        self.hist_y = np.full((1024, TRACK_HISTORY_LENGTH), -1, np.int32)
+        self.hist_head = np.zeros(1024, np.int32)
+        self.hist_len = np.zeros(1024, np.int32)
+        self.counted = np.zeros(1024, bool)  # Whether the track in each row has been counted
+        self.last_seen = np.zeros(1024, np.int64)  # Value of frames_seen when each row was last updated
+        # Row i lists ring positions oldest first for a ring whose oldest entry is at position i
+        self.ring_order = (np.arange(TRACK_HISTORY_LENGTH) + np.arange(TRACK_HISTORY_LENGTH)[:, None]) \
+            % TRACK_HISTORY_LENGTH
         self.entry_count = 0
         self.exit_count = 0
+        # Counts panel from (10, 10) to (300, 120), with its text re-rendered only when the counts change
+        self.counts_background = np.zeros((111, 291, 3), np.uint8)
+        self.counts_text = np.zeros((111, 291, 3), np.uint8)
+        self.counts_mask = np.zeros((111, 291, 1), bool)
+        self.shown_counts = None
         
-    def detect_and_track(self, frame):
-        """Detect people and track them across frames"""
-        # Run YOLOv8 tracking
-        results = self.model.track(frame, persist=True, classes=[0], 
-                                   conf=CONFIDENCE_THRESHOLD, verbose=False)
-        
-        detections = []
-        if results[0].boxes.id is not None:
-            boxes = results[0].boxes.xyxy.cpu().numpy()
-            track_ids = results[0].boxes.id.cpu().numpy().astype(int)
-            confidences = results[0].boxes.conf.cpu().numpy()
+    @property
+    def chunk_size(self):
+        """Number of consecutive frames that yields one full inference batch at the current stride"""
+        return BATCH_SIZE * self.stride
+    
+    def detect_and_track(self, frames):
+        """Detect and track people in consecutive frames, running detection only every stride frames"""
+        stride = self.stride
+        key_detections = self._detect_batch(frames[::stride])
+        
+        batch_detections = []
+        for i, detections in enumerate(key_detections):
+            key_idx = self.frame_idx + i * stride
+            velocities = self._velocities(detections, key_idx)
             
-            for box, track_id, conf in zip(boxes, track_ids, confidences):
-                x1, y1, x2, y2 = box
-                centroid_x = int((x1 + x2) / 2)
-                centroid_y = int((y1 + y2) / 2)
-                
-                detections.append({
-                    'bbox': (int(x1), int(y1), int(x2), int(y2)),
-                    'centroid': (centroid_x, centroid_y),
-                    'track_id': track_id,
-                    'confidence': conf
-                })
+            batch_detections.append(detections)
+            for step in range(1, min(stride, len(frames) - i * stride)):
+                batch_detections.append(self._extrapolate(detections, velocities, step))
+        
+        self.frame_idx += len(frames)
+        
+        # Skipping frames loses too much tracking accuracy in crowds
+        crowded = max(len(detections['ids']) for detections in key_detections) > CROWD_THRESHOLD
+        self._set_stride(1 if crowded else DETECTION_STRIDE)
+        
+        return batch_detections
+    
+    def _set_stride(self, stride):
+        """Set the detection stride, keeping the tracker's lost-track buffer constant in video frames"""
+        self.stride = stride
+        # The tracker only sees every stride-th frame, so lost tracks must expire after fewer updates
+        max_lost = max(1, round(TRACKER_ARGS['track_buffer'] / stride))
+        if hasattr(self.tracker, 'max_frames_lost'):  # ultralytics >= 8.4.38
+            self.tracker.max_frames_lost = max_lost
+        else:
+            self.tracker.max_time_lost = max_lost
+    
+    def _velocities(self, detections, key_idx):
+        """Estimate per-frame centroid motion of each detection since the previous detection frame"""
+        gap = key_idx - self.last_key_idx
+        prev = self.last_key_detections
+        velocities = np.zeros((len(detections['ids']), 2))
+        if gap > 0:
+            _, curr_idx, prev_idx = np.intersect1d(detections['ids'], prev['ids'], return_indices=True)
+            velocities[curr_idx] = (detections['cxy'][curr_idx] - prev['cxy'][prev_idx]) / gap
+        
+        self.last_key_idx = key_idx
+        self.last_key_detections = detections
+        return velocities
+    
+    def _extrapolate(self, detections, velocities, step):
+        """Shift detections along their estimated motion to fill in a skipped frame"""
+        offsets = (velocities * step).astype(np.int32)
+        return {
+            'xyxy': detections['xyxy'] + np.tile(offsets, 2),
+            'cxy': detections['cxy'] + offsets,
+            'ids': detections['ids']
+        }
+    
+    def _preprocess(self, frames):
+        """Letterbox a batch of BGR frames into a normalized RGB BCHW tensor on the inference device"""
+        # Upload as uint8 (4x fewer bytes than float) and convert on the device
+        images = torch.from_numpy(np.stack(frames)).to(self.device)
+        images = images.permute(0, 3, 1, 2).flip(1).float() / 255
+        
+        height, width = images.shape[2:]
+        input_height, input_width = self.input_shape
+        gain = min(input_height / height, input_width / width)
+        if gain != 1:
+            height, width = round(height * gain), round(width * gain)
+            images = torch.nn.functional.interpolate(images, size=(height, width), mode='bilinear',
+                                                     align_corners=False)
+        
+        # Pad to the network input shape, centered like ultralytics' letterbox
+        left = (input_width - width) // 2
+        top = (input_height - height) // 2
+        images = torch.nn.functional.pad(images, (left, input_width - width - left,
+                                                  top, input_height - height - top), value=114 / 255)
+        
+        return (images.half() if self.backend.fp16 else images), gain, (left, top)
+    
+    def _detect_batch(self, frames):
+        """Detect people in a batch of frames and update the tracker with each frame in order"""
+        # Pad a partial batch so the engine always sees the batch shape it was built for
+        batch = frames + [frames[-1]] * (BATCH_SIZE - len(frames))
+        images, gain, (left, top) = self._preprocess(batch)
+        results = non_max_suppression(self.backend(images), CONFIDENCE_THRESHOLD, iou_thres=0.7,
+                                      classes=[0])[:len(frames)]
+        
+        # Map the boxes back to frame coordinates and move the whole batch to the host in one copy
+        height, width = frames[0].shape[:2]
+        boxes = torch.cat(results).float()
+        boxes[:, 0:4:2] = ((boxes[:, 0:4:2] - left) / gain).clamp(0, width)
+        boxes[:, 1:4:2] = ((boxes[:, 1:4:2] - top) / gain).clamp(0, height)
+        boxes = np.split(boxes.cpu().numpy(), np.cumsum([len(result) for result in results])[:-1])
+        
+        # Tracking is sequential, so run ByteTrack frame by frame over the batched boxes
+        batch_detections = []
+        for frame, frame_boxes in zip(frames, boxes):
+            tracks = self.tracker.update(Boxes(frame_boxes, frame.shape[:2]), frame)
+            if len(tracks):
+                batch_detections.append(make_detections(tracks[:, :4], tracks[:, 4]))  # x1, y1, x2, y2, id
+            else:
+                batch_detections.append(make_detections([], []))
+        
+        return batch_detections
+    
+    def _track_slot(self, track_id):
+        """Return the history row of a track, allocating one for new IDs"""
+        slot = self.track_slots.get(track_id)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                slot = self.next_slot
+                self.next_slot += 1
+            if slot == len(self.hist_head):
+                # Double the capacity, new rows start empty
+                self.hist_x = np.concatenate([self.hist_x, np.full_like(self.hist_x, -1)])
+                self.hist_y = np.concatenate([self.hist_y, np.full_like(self.hist_y, -1)])
+                self.hist_head = np.concatenate([self.hist_head, np.zeros_like(self.hist_head)])
+                self.hist_len = np.concatenate([self.hist_len, np.zeros_like(self.hist_len)])
+                self.counted = np.concatenate([self.counted, np.zeros_like(self.counted)])
+                self.last_seen = np.concatenate([self.last_seen, np.zeros_like(self.last_seen)])
+            self.track_slots[track_id] = slot
+        return slot
+    
+    def _prune_stale_tracks(self):
+        """Release the history rows of tracks not seen for STALE_TRACK_FRAMES frames"""
+        stale = [(track_id, slot) for track_id, slot in self.track_slots.items()
+                 if self.frames_seen - self.last_seen[slot] > STALE_TRACK_FRAMES]
+        for track_id, slot in stale:
+            del self.track_slots[track_id]
+            self.free_slots.append(slot)
+        
+        slots = [slot for _, slot in stale]
+        self.hist_head[slots] = 0
+        self.hist_len[slots] = 0
+        self.counted[slots] = False
+    
+    def track_points(self, track_id):
+        """Return the stored centroids of a track, oldest first, as an (N, 2) int32 array"""
+        slot = self.track_slots.get(track_id)
+        if slot is None:
+            return np.empty((0, 2), np.int32)
         
-        return detections
+        length = self.hist_len[slot]
+        idx = self.ring_order[(self.hist_head[slot] - length) % TRACK_HISTORY_LENGTH, :length]
+        return np.stack([self.hist_x[slot, idx], self.hist_y[slot, idx]], axis=1)
+    
+    def _counting_line(self, frame_height):
+        """Return the y coordinate of the counting line, computed once per video"""
+        if self.counting_line_y is None:
+            self.counting_line_y = int(frame_height * self.line_position)
+        return self.counting_line_y
     
     def update_counts(self, detections, frame_height):
         """Update entry and exit counts based on line crossing"""
-        counting_line_y = int(frame_height * self.line_position)
+        self.frames_seen += 1
+        if self.frames_seen % STALE_TRACK_FRAMES == 0:
+            self._prune_stale_tracks()
         
-        for detection in detections:
-            track_id = detection['track_id']
-            centroid = detection['centroid']
-            
-            # Store track history
-            self.track_history[track_id].append(centroid)
-            if len(self.track_history[track_id]) > TRACK_HISTORY_LENGTH:
-                self.track_history[track_id].pop(0)
-            
-            # Check for line crossing
-            if len(self.track_history[track_id]) >= 2 and track_id not in self.counted_ids:
-                prev_y = self.track_history[track_id][-2][1]
-                curr_y = self.track_history[track_id][-1][1]
-                
-                # Check if crossed from top to bottom (Entry)
-                if prev_y < counting_line_y and curr_y >= counting_line_y:
-                    self.entry_count += 1
-                    self.counted_ids.add(track_id)
-                
-                # Check if crossed from bottom to top (Exit)
-                elif prev_y > counting_line_y and curr_y <= counting_line_y:
-                    self.exit_count += 1
-                    self.counted_ids.add(track_id)
+        if len(detections['ids']) == 0:
+            return
+        
+        counting_line_y = self._counting_line(frame_height)
+        slots = np.array([self._track_slot(track_id) for track_id in detections['ids'].tolist()], np.intp)
+        
+        self.last_seen[slots] = self.frames_seen
+        entries, exits = _update_counts_kernel(detections['cxy'], slots, self.hist_x, self.hist_y, self.hist_head,
+                                               self.hist_len, self.counted, counting_line_y)
+        self.entry_count += entries
+        self.exit_count += exits
     
     def draw_visualizations(self, frame, detections):
         """Draw bounding boxes, trajectories, and counting line"""
         frame_height, frame_width = frame.shape[:2]
-        counting_line_y = int(frame_height * self.line_position)
+        counting_line_y = self._counting_line(frame_height)
         
         # Draw counting line
         cv2.line(frame, (0, counting_line_y), (frame_width, counting_line_y), 
@@ -91,54 +471,154 @@ class FootfallCounter:
         cv2.putText(frame, "COUNTING LINE", (10, counting_line_y - 10),
                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
         
+        # Look up which tracks have been counted in one gather
+        track_ids = detections['ids'].tolist()
+        counted_mask = self.counted[[self.track_slots[track_id] for track_id in track_ids]]
+        trajectories = {(0, 255, 0): [], (255, 0, 0): []}
+        
         # Draw detections
-        for detection in detections:
-            bbox = detection['bbox']
-            centroid = detection['centroid']
-            track_id = detection['track_id']
-            
+        for (x1, y1, x2, y2), centroid, track_id, counted in zip(detections['xyxy'].tolist(),
+                                                                 detections['cxy'].tolist(),
+                                                                 track_ids, counted_mask):
             # Draw bounding box
-            color = (0, 255, 0) if track_id in self.counted_ids else (255, 0, 0)
-            cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[2], bbox[3]), color, 2)
+            color = (0, 255, 0) if counted else (255, 0, 0)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
             
             # Draw track ID
-            cv2.putText(frame, f"ID: {track_id}", (bbox[0], bbox[1] - 10),
+            cv2.putText(frame, f"ID: {track_id}", (x1, y1 - 10),
                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
             
             # Draw centroid
             cv2.circle(frame, centroid, 4, color, -1)
             
-            # Draw trajectory
-            if track_id in self.track_history and len(self.track_history[track_id]) > 1:
-                points = np.array(self.track_history[track_id], dtype=np.int32)
-                cv2.polylines(frame, [points], False, color, 2)
+            # Collect trajectory
+            points = self.track_points(track_id)
+            if len(points) > 1:
+                trajectories[color].append(points)
+        
+        # Draw trajectories with one call per color
+        for color, polylines in trajectories.items():
+            if polylines:
+                cv2.polylines(frame, polylines, False, color, 2)
         
         return frame
     
     def draw_counts(self, frame):
         """Draw entry, exit, and total counts on frame"""
-        # Create semi-transparent overlay for text background
-        overlay = frame.copy()
-        cv2.rectangle(overlay, (10, 10), (300, 120), (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.6, frame, 0.4, 0, frame)
+        # Render counts into the cached panel text when they change (coordinates relative to the panel,
+        # hard-edged lines so the mask covers the text exactly)
+        counts = (self.entry_count, self.exit_count)
+        if counts != self.shown_counts:
+            self.counts_text[:] = 0
+            cv2.putText(self.counts_text, f"Entries: {self.entry_count}", (10, 30),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2, cv2.LINE_8)
+            cv2.putText(self.counts_text, f"Exits: {self.exit_count}", (10, 60),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2, cv2.LINE_8)
+            cv2.putText(self.counts_text, f"Total: {self.entry_count - self.exit_count}", (10, 90),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2, cv2.LINE_8)
+            self.counts_mask = self.counts_text.max(axis=2, keepdims=True) >= 128
+            self.shown_counts = counts
+        
+        # Darken the panel area in place for a semi-transparent text background
+        # (the slice is clipped on frames smaller than the panel)
+        panel = frame[10:121, 10:301]
+        panel_height, panel_width = panel.shape[:2]
+        cv2.addWeighted(self.counts_background[:panel_height, :panel_width], 0.6, panel, 0.4, 0, panel)
         
         # Draw counts
-        cv2.putText(frame, f"Entries: {self.entry_count}", (20, 40),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
-        cv2.putText(frame, f"Exits: {self.exit_count}", (20, 70),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-        cv2.putText(frame, f"Total: {self.entry_count - self.exit_count}", (20, 100),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2)
+        np.copyto(panel, self.counts_text[:panel_height, :panel_width],
+                  where=self.counts_mask[:panel_height, :panel_width])
         
         return frame
 
+class FrameReader(threading.Thread):
+    """Decode frames on a background thread so decoding overlaps with inference"""
+    def __init__(self, cap, maxsize=BATCH_SIZE * DETECTION_STRIDE):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.finished = False
+    
+    def run(self):
+        while not self.stopped.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            self.queue.put(frame)
+        self.queue.put(None)  # End of stream
+    
+    def read_batch(self, size):
+        """Return up to size frames, fewer (or none) once the stream has ended"""
+        frames = []
+        while len(frames) < size and not self.finished:
+            frame = self.queue.get()
+            if frame is None:
+                self.finished = True
+            else:
+                frames.append(frame)
+        return frames
+    
+    def stop(self):
+        """Stop decoding, draining the queue so a blocked put() can return"""
+        self.stopped.set()
+        while self.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+class FrameWriter(threading.Thread):
+    """Encode annotated frames to a video file on a background thread"""
+    def __init__(self, path, fps, frame_size, maxsize=2 * BATCH_SIZE):
+        super().__init__(daemon=True)
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.writer = cv2.VideoWriter(path, fourcc, fps, frame_size)
+        self.queue = queue.Queue(maxsize=maxsize)
+    
+    def run(self):
+        while (frame := self.queue.get()) is not None:
+            self.writer.write(frame)
+        self.writer.release()
+    
+    def write(self, frame):
+        self.queue.put(frame)
+    
+    def close(self):
+        """Flush the remaining frames and release the writer"""
+        self.queue.put(None)
+        self.join()
+
+def display_available():
+    """Return whether a GUI display is available for cv2.imshow"""
+    if sys.platform.startswith('linux'):
+        return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return True
+
+def handle_keys():
+    """Handle ESC (quit) and SPACE (pause/resume) key presses, blocking while paused"""
+    paused = False
+    key = cv2.pollKey() & 0xFF
+    while True:
+        if key == 27:  # ESC
+            return True
+        if key == 32:  # SPACE
+            paused = not paused
+            print("Paused" if paused else "Resumed")
+        if not paused:
+            return False
+        key = cv2.waitKey(0) & 0xFF
+
 def main():
     """Main function to run the footfall counter"""
-    # Initialize counter
-    counter = FootfallCounter(line_position=LINE_POSITION)
+    parser = argparse.ArgumentParser(description="Count people crossing a virtual line in a video")
+    parser.add_argument('--no-display', dest='display', action='store_false',
+                        help="skip drawing and the preview window (e.g. for batch processing)")
+    args = parser.parse_args()
+    display = args.display and display_available()
     
     # Open video
-    cap = cv2.VideoCapture(VIDEO_PATH)
+    cap = open_video(VIDEO_PATH)
     
     if not cap.isOpened():
         print(f"Error: Could not open video file {VIDEO_PATH}")
@@ -146,62 +626,85 @@ def main():
     
     # Get video properties
     fps = int(cap.get(cv2.CAP_PROP_FPS))
+    if fps <= 0:
+        fps = 30  # Some webcams do not report their frame rate
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     
     print(f"Video loaded: {frame_width}x{frame_height} @ {fps} FPS")
-    print("Processing... Press 'ESC' to quit, 'SPACE' to pause")
+    
+    # Initialize counter with the video resolution so the engine is built for that exact shape
+    counter = FootfallCounter(line_position=LINE_POSITION, frame_size=(frame_height, frame_width))
+    if display:
+        print("Processing... Press 'ESC' to quit, 'SPACE' to pause")
+    else:
+        print("Processing without display... Press Ctrl+C to quit")
+    
+    # Decode on a background thread
+    reader = FrameReader(cap)
+    reader.start()
     
     # Optional: Save output video
-    # fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    # out = cv2.VideoWriter('output.mp4', fourcc, fps, (frame_width, frame_height))
+    writer = None
+    if OUTPUT_PATH:
+        writer = FrameWriter(OUTPUT_PATH, fps, (frame_width, frame_height))
+        writer.start()
     
     frame_count = 0
-    paused = False
+    quit_requested = False
     
-    while True:
-        if not paused:
-            ret, frame = cap.read()
-            if not ret:
+    try:
+        while not quit_requested:
+            # Read the next chunk of frames
+            frames = reader.read_batch(counter.chunk_size)
+            if not frames:
                 print("\nEnd of video reached")
                 break
             
-            frame_count += 1
-            
-            # Detect and track people
-            detections = counter.detect_and_track(frame)
-            
-            # Update counts based on line crossing
-            counter.update_counts(detections, frame_height)
-            
-            # Draw visualizations
-            frame = counter.draw_visualizations(frame, detections)
-            frame = counter.draw_counts(frame)
+            # Detect and track people in the whole chunk with one inference call
+            batch_detections = counter.detect_and_track(frames)
             
-            # Optional: Write to output video
-            # out.write(frame)
-            
-            # Display progress every 30 frames
-            if frame_count % 30 == 0:
-                print(f"Frame {frame_count}: Entries={counter.entry_count}, "
-                      f"Exits={counter.exit_count}, "
-                      f"Current={counter.entry_count - counter.exit_count}")
-        
-        # Display frame
-        cv2.imshow("Footfall Counter", frame)
-        
-        # Handle key presses
-        key = cv2.waitKey(1 if not paused else 0) & 0xFF
-        if key == 27:  # ESC
-            break
-        elif key == 32:  # SPACE
-            paused = not paused
-            print("Paused" if paused else "Resumed")
+            for frame, detections in zip(frames, batch_detections):
+                frame_count += 1
+                
+                # Update counts based on line crossing
+                counter.update_counts(detections, frame_height)
+                
+                # Draw visualizations (skipped when nothing would show them)
+                if display or writer:
+                    frame = counter.draw_visualizations(frame, detections)
+                    frame = counter.draw_counts(frame)
+                
+                # Optional: Write to output video
+                if writer:
+                    writer.write(frame)
+                
+                # Display progress every 30 frames
+                if frame_count % 30 == 0:
+                    print(f"Frame {frame_count}: Entries={counter.entry_count}, "
+                          f"Exits={counter.exit_count}, "
+                          f"Current={counter.entry_count - counter.exit_count}")
+                
+                if display:
+                    # Display frame
+                    preview = cv2.resize(frame, None, fx=PREVIEW_SCALE, fy=PREVIEW_SCALE,
+                                         interpolation=cv2.INTER_AREA)
+                    cv2.imshow("Footfall Counter", preview)
+                    
+                    # Handle key presses
+                    if handle_keys():
+                        quit_requested = True
+                        break
+    except KeyboardInterrupt:
+        print("\nInterrupted")
     
     # Cleanup
+    reader.stop()
     cap.release()
-    # out.release()
-    cv2.destroyAllWindows()
+    if writer:
+        writer.close()
+    if display:
+        cv2.destroyAllWindows()
     
     # Print final results
     print("\n" + "="*50)